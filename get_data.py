@@ -3,7 +3,7 @@ from src import KNMIApp
 from pathlib import Path
 
 parent = Path.cwd()
-merge_file = parent / 'assets/merged_data/merged_dataset.nc'
+merge_file = parent / 'assets/merged_data/merged_dataset.zarr'
 
 knmi_app = KNMIApp(merge_file)
 
@@ -1,5 +1,6 @@
 import logging
 import os
+import shutil
 import sys
 from datetime import datetime
 from datetime import timedelta
@@ -54,9 +55,9 @@ def download_file_from_temporary_download_url(download_url, filename):
     try:
         with requests.get(download_url, stream=True) as r:
             r.raise_for_status()
+            r.raw.decode_content = True
             with open(filename, "wb") as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+                shutil.copyfileobj(r.raw, f, length=131072)
     except Exception:
         logger.exception("Unable to download file using download URL")
         sys.exit(1)
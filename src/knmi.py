@@ -1,40 +1,74 @@
+from functools import cached_property
 from pathlib import Path
+import asyncio
+import aiofiles
+import httpx
 import pandas as pd
-import requests
 import warnings
 from typing import Union
 import xarray as xr
-from tqdm import tqdm
-from glob import glob
+
+try:
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+except ImportError:
+    plt = None
+
+MAX_CONCURRENT_DOWNLOADS = 16
+DOWNLOAD_CHUNK_SIZE = 131072  # 128 KiB
+MAX_RETRIES = 5
+RETRY_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 class KNMIApp:
     def __init__(self, nc_file_abs_path: Union[Path, str]):
         self.nc_file_abs_path = Path(nc_file_abs_path)
-        assert self.nc_file_abs_path.is_file(), "NC file does not exist."
+        assert self.nc_file_abs_path.exists(), "Data store does not exist."  # A .zarr store is a folder
         self.ds = self.load_data(self.nc_file_abs_path)
+        # Positional lookups are the fastest xarray indexing path; precompute them once.
+        self._station_pos = {code: position for position, code in enumerate(self.ds.station.values)}
+        self._time_index = pd.DatetimeIndex(self.ds.time.values)
 
     @staticmethod
     def load_data(nc_file_abs_path):
         try:
-            with xr.open_dataset(nc_file_abs_path) as ds:
-                nc_data = ds.copy(deep=True)
+            # Keep the dataset lazy: variables are read on demand instead of deep-copied into RAM.
+            nc_file_abs_path = Path(nc_file_abs_path)
+            if nc_file_abs_path.suffix == '.zarr':
+                nc_data = xr.open_zarr(nc_file_abs_path, chunks={'time': 144})
+            else:
+                nc_data = xr.open_dataset(nc_file_abs_path, chunks={'time': 144}, engine='h5netcdf')
             print('Load successful!')
             return nc_data
         except FileNotFoundError:
             print('NC file not found!')
             return None
 
+    def close(self):
+        if self.ds is not None:
+            self.ds.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @cached_property
+    def station_info(self):
+        return pd.DataFrame({'code': self.ds.station.values,
+                             'station_name': self.ds['stationname'].values,
+                             'lat': self.ds['lat'].values,
+                             'lon': self.ds['lon'].values})
+
     def get_station_codes(self, verbose=True):
-        self.station_info = pd.DataFrame({'code': self.ds.station.values,
-                                          'station_name': self.ds['stationname'].values,
-                                          'lat': self.ds['lat'].values,
-                                          'lon': self.ds['lon'].values})
         if verbose:
             print(self.station_info)
 
         return self.station_info
 
-    def get_variables_info(self, verbose=False):
+    @cached_property
+    def variable_info(self):
         assert self.ds is not None, 'Load the dataset first.'
 
         variable_names = list(self.ds._variables.keys())
@@ -51,12 +85,18 @@ class KNMIApp:
             except AttributeError:
                 pass
 
-        self.variable_info = pd.DataFrame({'variable': var_names, 'information': var_info, 'units': var_units})
+        return pd.DataFrame({'variable': var_names, 'information': var_info, 'units': var_units})
 
+    def get_variables_info(self, verbose=False):
         if verbose: print(self.variable_info)
 
         return self.variable_info
 
+    @cached_property
+    def _var_meta(self):
+        info = self.variable_info
+        return dict(zip(info.variable, zip(info.information, info.units)))
+
     def get_time_range_dataset(self, verbose=False):
         minimum_date = pd.to_datetime(self.ds.time.values.min())
         maximum_date = pd.to_datetime(self.ds.time.values.max())
@@ -108,25 +148,25 @@ class KNMIApp:
                 print("You can not plot 2 variables in the same graph... disabling plot...")
                 plot = False
 
+        station_data = self.ds.isel(station=self._station_pos[station])
+
         if start is not None and end is not None:
-            data = self.ds.sel(station=station, time=slice(start, end))
+            # slice_indexer yields an integer slice for isel while keeping pandas' partial-string
+            # semantics, so a date-only end still includes that whole day as slice-by-label did.
+            data = station_data.isel(time=self._time_index.slice_indexer(start, end))
 
         else:
-            data = self.ds.sel(station=station)
+            data = station_data
 
         data_frame = data[variable].to_dataframe()
         data_frame.drop(columns=['station'], inplace=True)
 
         if plot:
-            try:
-                import matplotlib.pyplot as plt
-                import matplotlib.dates as mdates
-            except ImportError:
+            if plt is None:
                 print("Please install Matplotlib before.")
                 return data_frame
 
-            info = self.get_variables_info(verbose=False)
-            idx = info.variable == variable
+            long_name, units = self._var_meta[variable]
             hours = mdates.HourLocator(interval=2)  # Every 3 - hour
             days = mdates.DayLocator()  # Every day
 
@@ -141,8 +181,8 @@ class KNMIApp:
             ax.xaxis.set_minor_locator(hours)
             ax.xaxis.set_minor_formatter(mdates.DateFormatter('%H'))
             ax.tick_params(which='minor', length=2, color='r', labelsize=6)
-            ax.set_title(info['information'][idx].values.item())
-            ax.set_ylabel(info['units'][idx].values.item())
+            ax.set_title(long_name)
+            ax.set_ylabel(units)
             ax.set_xlabel('Time')
             ax.grid(which='major', linewidth=1)
             ax.grid(which='minor', linestyle='--', linewidth=0.4, alpha=0.8)
@@ -153,18 +193,12 @@ class KNMIApp:
 
 
 
-def filename_to_date(filename: str) -> pd.Timestamp:
-    full_date = filename[-12:]
-    year = full_date[:4]
-    month = full_date[4:6]
-    day = full_date[6:8]
-    hour = full_date[8:10]
-    minute = full_date[10:12]
-    second = "00"
-
-    time_stamp = pd.to_datetime(f"{year}-{month}-{day} {hour}:{minute}:{second}")
+def filenames_to_dates(stems: pd.Series) -> pd.DatetimeIndex:
+    # The stems end in YYYYMMDDHHMM; supplying the format keeps pandas on its fast C parser path.
+    return pd.DatetimeIndex(pd.to_datetime(stems.str.slice(-12), format='%Y%m%d%H%M', cache=True))
 
-    return time_stamp
+def filename_to_date(filename: str) -> pd.Timestamp:
+    return filenames_to_dates(pd.Series([filename]))[0]
 
 def download_files(abs_path_download_folder: Union[str, Path], api_key:str, max_downloads:int=100) -> int:
     api_url = "https://api.dataplatform.knmi.nl/open-data"
@@ -178,85 +212,202 @@ def download_files(abs_path_download_folder: Union[str, Path], api_key:str, max_
 
     assert abs_path_download_folder_.exists(), f"Folder '{abs_path_download_folder_}' does not exist."
 
-    last_file = sorted(abs_path_download_folder_.glob("*.nc"))[-1].stem
-    max_date = filename_to_date(last_file)
+    stems = pd.Series([file.stem for file in abs_path_download_folder_.glob("*.nc")], dtype=str)
+    assert not stems.empty, f"Folder '{abs_path_download_folder_}' has no .nc files to resume from."
+
+    max_date = filenames_to_dates(stems).max()
     print(f"Max date found in folder: {max_date}")
 
     start_after_filename = file_head + max_date.strftime('%Y%m%d%H%M') + ".nc"
 
-    list_files_response = requests.get(
-        f"{api_url}/datasets/{dataset_name}/versions/{dataset_version}/files",
-        headers={"Authorization": api_key},
-        params={"maxKeys": max_keys,
-                "startAfterFilename": start_after_filename})
+    asyncio.run(_download_files_async(api_url=api_url,
+                                      dataset_name=dataset_name,
+                                      dataset_version=dataset_version,
+                                      max_keys=max_keys,
+                                      start_after_filename=start_after_filename,
+                                      api_key=api_key,
+                                      maximum_quota=maximum_quota,
+                                      abs_path_download_folder=abs_path_download_folder_))
 
-    if list_files_response.status_code == 403:
-        print(f"Access denied. Quota exceeded")
-        return 0
+    return 0
 
-    response = list_files_response.json()
-    files_list = response.get('files')  # Name of the files available in the server
-    data_frame = pd.DataFrame(files_list)
 
-    print(f'Files available in the KNMI Server to update local file: {data_frame.shape[0]}')
-    print(data_frame)
+async def _download_files_async(api_url, dataset_name, dataset_version, max_keys, start_after_filename,
+                                api_key, maximum_quota, abs_path_download_folder):
+    # One client for the listing and every file fetch: with HTTP/2 the requests are multiplexed over
+    # a handful of kept-alive connections, so the TCP+TLS handshake is not paid again per request.
+    # The api_key is attached per request, never as a client default: the temporary download urls are
+    # pre-signed and reject (and must not receive) an extra Authorization header.
+    limits = httpx.Limits(max_connections=MAX_CONCURRENT_DOWNLOADS,
+                          max_keepalive_connections=MAX_CONCURRENT_DOWNLOADS)
+    async with httpx.AsyncClient(http2=True, limits=limits) as client:
+        list_files_response = await _get_with_retries(
+            client,
+            f"{api_url}/datasets/{dataset_name}/versions/{dataset_version}/files",
+            headers={"Authorization": api_key},
+            params={"maxKeys": max_keys,
+                    "startAfterFilename": start_after_filename})
+
+        if list_files_response.status_code == 403:
+            print(f"Access denied. Quota exceeded")
+            return 0
+
+        response = list_files_response.json()
+
+        files_list = response.get('files')  # Name of the files available in the server
+        data_frame = pd.DataFrame(files_list)
+
+        if data_frame.empty:
+            print('Local files are up to date with the KNMI Server.')
+            return 0
+
+        print(f'Files available in the KNMI Server to update local file: {data_frame.shape[0]}')
+        print(data_frame)
+
+        if maximum_quota >= data_frame.shape[0]:
+            max_number_files = data_frame.shape[0]
+        else:
+            max_number_files = maximum_quota
 
-    if maximum_quota >= data_frame.shape[0]:
-        max_number_files = data_frame.shape[0]
-    else:
-        max_number_files = maximum_quota
-
-    for file_number in range(max_number_files):
-        print(f"Retrieving file {file_number} of {maximum_quota}.")
-        get_file_response = requests.get(
-            f"{api_url}/datasets/{dataset_name}/versions/{dataset_version}/files/{data_frame.filename[file_number]}/url",
-            headers={"Authorization": api_key})
-
-        if get_file_response.status_code == 200:
-            download_url = get_file_response.json().get("temporaryDownloadUrl")
-            with open(f'{abs_path_download_folder_}/{data_frame.filename[file_number]}', 'wb') as file_write:
-                file_write.write(requests.get(download_url).content)
-        elif get_file_response.status_code == 403:
-            warnings.warn('Download stop!! Maximum requests reached to the KNMI API Server.')
+        # Skip files already on disk, saving one url fetch and one download per file.
+        existing_files = {file.name for file in abs_path_download_folder.iterdir() if file.suffix == '.nc'}
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        tasks = [_download_one_file(semaphore, client, api_url, dataset_name, dataset_version, api_key,
+                                    filename, abs_path_download_folder)
+                 for filename in data_frame.filename[:max_number_files]
+                 if filename not in existing_files]
+        results = await asyncio.gather(*tasks)
+
+    downloaded_files = sum(results)
+    print(f"Downloading successfully! ({downloaded_files} of {max_number_files} files)")
+
+    return downloaded_files
+
+
+async def _get_with_retries(client, url, **kwargs):
+    # Retry transient failures with exponential backoff, honoring the Retry-After header when sent.
+    response = await client.get(url, **kwargs)
+    for attempt in range(MAX_RETRIES):
+        if response.status_code not in RETRY_STATUS_CODES:
             break
 
-    print("Downloading successfully!")
+        await asyncio.sleep(_retry_delay(response, attempt))
+        response = await client.get(url, **kwargs)
 
-    return 0
+    return response
 
 
-def merge_nc_files(downloads_folder: Union[str, Path],
-                   merge_folder: Union[str, Path]):
+def _retry_delay(response, attempt):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return RETRY_BACKOFF_FACTOR * 2 ** attempt
 
-    file_merged = "merged_dataset"
-    files = sorted(downloads_folder.glob("*.nc"))
 
-    data_sets = []
-    merged_batch = []
-    for ii, file in enumerate(tqdm(files)):
-        with xr.open_dataset(file) as ds:
-            data_sets.append(ds.copy(deep=True))
+async def _download_one_file(semaphore, client, api_url, dataset_name, dataset_version, api_key,
+                             filename, abs_path_download_folder):
+    url_endpoint = f"{api_url}/datasets/{dataset_name}/versions/{dataset_version}/files/{filename}/url"
+    async with semaphore:
+        get_file_response = await _get_with_retries(client, url_endpoint,
+                                                    headers={"Authorization": api_key})
+        if get_file_response.status_code == 403:
+            warnings.warn('Download stop!! Maximum requests reached to the KNMI API Server.')
+            return False
+        elif get_file_response.status_code != 200:
+            warnings.warn(f"Could not retrieve the download url for file '{filename}' "
+                          f"(HTTP {get_file_response.status_code}).")
+            return False
+
+        download_url = get_file_response.json().get("temporaryDownloadUrl")
+
+        for attempt in range(MAX_RETRIES):
+            async with client.stream('GET', download_url) as download_response:
+                if download_response.status_code in RETRY_STATUS_CODES:
+                    delay = _retry_delay(download_response, attempt)
+                elif download_response.status_code != 200:
+                    warnings.warn(f"Could not download file '{filename}' "
+                                  f"(HTTP {download_response.status_code}).")
+                    return False
+                else:
+                    async with aiofiles.open(abs_path_download_folder / filename, 'wb') as file_write:
+                        async for chunk in download_response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            await file_write.write(chunk)
+                    break
+
+            await asyncio.sleep(delay)
+        else:
+            warnings.warn(f"Retries exhausted downloading file '{filename}'.")
+            return False
+
+    print(f"Retrieved file: {filename}")
 
-        if (ii + 1) % 500 == 0:
-            print(f"Merging a batch of 500 files....")
-            merged_batch.append(xr.merge(data_sets))
-            data_sets = []
+    return True
 
-    data_set_merging = xr.merge(data_sets)  # IF less than 1000 or non multiple of 1000 e.g. 1002 -- 2 files are lost
-    merged_batch_merging = xr.merge(merged_batch)
-    merged_downloaded_files =  xr.merge([merged_batch_merging, data_set_merging])
 
-    if Path(merge_folder / f'{file_merged}.nc').is_file():
-        path_local_merged_file = glob(str(merge_folder / 'merged*.nc'))
-        merged_local_database_file = []
-        with xr.open_dataset(path_local_merged_file[0]) as ds:
-            merged_local_database_file.append(ds.copy(deep=True))
+def merge_nc_files(downloads_folder: Union[str, Path],
+                   merge_folder: Union[str, Path]):
 
-        # 3. Merge the downloaded files (one single .nc file) with the local database.
-        merge_data_sets = xr.merge([merged_downloaded_files, merged_local_database_file[0]])
+    downloads_folder = Path(downloads_folder)
+    merge_folder = Path(merge_folder)
 
-        merge_data_sets.to_netcdf(merge_folder/ f'{file_merged}.nc')  # Rewrite the file
+    file_merged = "merged_dataset"
+    store = merge_folder / f'{file_merged}.zarr'
+    legacy_file = merge_folder / f'{file_merged}.nc'
+
+    if not store.exists() and legacy_file.is_file():
+        # One-off migration: netCDF cannot grow the time dimension in place (mode='a' only adds new
+        # variables), so the Zarr store is the append path. Seed it from the legacy archive so the
+        # new data continues from the history already collected.
+        print(f"Migrating legacy archive '{legacy_file.name}' to '{store.name}'.")
+        with xr.open_dataset(legacy_file, chunks={'time': 144}, engine='h5netcdf') as legacy_data:
+            _initialize_store(legacy_data, store)
+
+    files = sorted(downloads_folder.glob("*.nc"))  # combine='nested' concatenates in list order, so keep the sort
+    if not files:
+        print(f"No .nc files found in '{downloads_folder}'.")
+        return
+
+    if store.exists():
+        # The downloads folder keeps every file ever fetched, so appending it wholesale would
+        # duplicate the timestamps already in the archive; only strictly newer files are appended.
+        with xr.open_zarr(store) as stored_data:
+            max_stored_date = pd.to_datetime(stored_data.time.values.max())
+        file_dates = filenames_to_dates(pd.Series([file.stem for file in files], dtype=str))
+        files = [file for file, file_date in zip(files, file_dates) if file_date > max_stored_date]
+
+        if not files:
+            print('Local archive is already up to date.')
+            return
+
+    # Open all the downloaded files lazily in one go: Dask parallelizes the per-file opens, keeps
+    # memory bounded through the chunks, and no file is dropped by the old batch-of-500 logic.
+    merged_downloaded_files = xr.open_mfdataset(files, combine='nested', concat_dim='time',
+                                                data_vars='minimal', coords='minimal', compat='override',
+                                                parallel=True, chunks={'time': 144}, engine='h5netcdf')
+
+    if store.exists():
+        # Appending along time writes only the new slices; readers can keep the store open meanwhile.
+        # Variables without a time dimension (stationname, lat, lon, ...) cannot be appended along
+        # time and are already in the store, so they are left out.
+        time_variables = [variable for variable in merged_downloaded_files.data_vars
+                          if 'time' in merged_downloaded_files[variable].dims]
+        # One time chunk for the whole batch, so a single task writes the appended region; the
+        # per-file chunks of one step would read-modify-write the store's last zarr chunk from
+        # many tasks at once.
+        merged_downloaded_files[time_variables].chunk({'time': -1}).to_zarr(store, append_dim='time')
     else:
-        merge_data_sets = xr.merge([merged_downloaded_files])
-        merge_data_sets.to_netcdf(merge_folder/ f'{file_merged}.nc')  # Create new file database
+        _initialize_store(merged_downloaded_files, store)  # Create new database
+
+
+def _initialize_store(data_set, store):
+    # Chunks of ~1 day of time steps over all stations, matching the slicing done by get_data. The
+    # per-station and scalar metadata variables have other shapes and keep the default chunking.
+    # Rechunk first: the data arrives with one Dask chunk per input file (or the 144-step read
+    # chunks), which would overlap the larger zarr chunks and make to_zarr refuse the write.
+    data_set = data_set.chunk({'time': 1440})
+    encoding = {variable: {'chunks': (1440, data_set.station.size)}
+                for variable in data_set.data_vars
+                if data_set[variable].dims == ('time', 'station')}
+    data_set.to_zarr(store, mode='w', encoding=encoding)
 
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from src.knmi import merge_nc_files
+
+FILE_HEAD = "KMDS__OPER_P___10M_OBS_L2_"
+STATIONS = ['06391', '06392', '06393']
+
+
+def write_station_file(folder: Path, timestamp: pd.Timestamp):
+    data_set = xr.Dataset({'ta': (('time', 'station'), np.random.rand(1, len(STATIONS))),
+                           'stationname': (('station',), ['A', 'B', 'C']),
+                           'lat': (('station',), [52.1, 52.2, 52.3]),
+                           'lon': (('station',), [4.1, 4.2, 4.3])},
+                          coords={'time': pd.DatetimeIndex([timestamp]), 'station': STATIONS})
+    data_set.to_netcdf(folder / f"{FILE_HEAD}{timestamp.strftime('%Y%m%d%H%M')}.nc", engine='h5netcdf')
+
+
+def test_merge_creates_store_from_multiple_files(tmp_path):
+    downloads_folder = tmp_path / 'downloads'
+    merge_folder = tmp_path / 'merged_data'
+    downloads_folder.mkdir()
+    merge_folder.mkdir()
+
+    time_stamps = pd.date_range('2022-01-01 00:00:00', periods=10, freq='10min')
+    for time_stamp in time_stamps:
+        write_station_file(downloads_folder, time_stamp)
+
+    merge_nc_files(downloads_folder=downloads_folder, merge_folder=merge_folder)
+
+    with xr.open_zarr(merge_folder / 'merged_dataset.zarr') as data_set:
+        assert data_set.time.size == len(time_stamps)
+        assert list(pd.DatetimeIndex(data_set.time.values)) == list(time_stamps)
@@ -1,7 +1,6 @@
 from src import download_files
 from dotenv import dotenv_values
 from pathlib import Path
-from tqdm import tqdm
 import time
 
 config = dotenv_values(".env")
@@ -14,8 +13,7 @@ downloads_folder = parent / 'assets/downloads'
 
 while True:
     download_files(abs_path_download_folder=downloads_folder, api_key=api_key, max_downloads=99)
-    for _ in tqdm(range(60 * 60)):
-        time.sleep(1)
+    time.sleep(60 * 10)  # The KNMI dataset publishes new files every 10 minutes
 
 
 